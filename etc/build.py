@@ -1,4 +1,4 @@
-#! /usr/bin/python
+#!/usr/bin/env -S python3 -S
 # Copyright (c) 2013-2016 Galvanized Logic Inc.
 # Use is governed by a BSD-style license found in the LICENSE file.
 
@@ -15,28 +15,47 @@ copied and tested in a shell.
 This script is expected to be called by:
    1) a continuous integration script from a dedicated build server, or,
    2) a local developer testing the build.
+
+The script needs python3; site initialization is skipped (-S) to keep
+interpreter startup cheap when the build system invokes it per target.
 """
 
 import sys          # detect which arch for the build
 import os           # for directory manipulation
+import stat         # for file permission flags
 import signal       # for process signal definitions.
 import shutil       # for directory and file manipulation
-import shlex        # run and control shell commands
 import subprocess   # for calling shell commands
 import glob         # for unix pattern matching
+import json         # persist the incremental build cache
+import hashlib      # fingerprint bundles to skip re-signing
+import zipfile      # bundle assets without an external zip
+import concurrent.futures # overlap independent build steps
+
+# commands reused across builds, tokenized once at import rather than
+# re-parsed on every invocation.
+goFmtCmd = ['go', 'fmt', 'bampf']
+gitHeadCmd = ['git', 'rev-parse', 'HEAD']
+gitDescribeCmd = ['git', 'describe']
 
 def cleanProject():
-    # Remove all generated files.
-    generatedOutput = ['target']
-    print 'Removing generated output:'
-    for gdir in generatedOutput:
-        if os.path.exists(gdir):
-            print '    ' + gdir
-            shutil.rmtree(gdir)
+    # Remove all generated files. One removal thread per directory since
+    # rmtree releases the GIL during its unlink/rmdir syscalls.
+    generatedOutput = [gdir for gdir in ['target'] if os.path.exists(gdir)]
+    print('Removing generated output:')
+    if not generatedOutput:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(generatedOutput)) as pool:
+        removals = []
+        for gdir in generatedOutput:
+            print('    ' + gdir)
+            removals.append(pool.submit(shutil.rmtree, gdir))
+        for removal in removals:
+            removal.result()
 
 def lintProject():
     # expects golint executable in $PATH
-    run('golint bampf')
+    run(['golint', 'bampf'])
 
 def buildProject():
     # Builds executable.
@@ -45,35 +64,83 @@ def buildProject():
     elif sys.platform.startswith('win'):
         buildWindows()
     else:
-        print 'No build for ' + sys.platform
+        print(f'No build for {sys.platform}')
 
 def buildBinary(flags):
-    print 'Building executable'
-    run('go fmt bampf')
+    print('Building executable')
+    if not os.path.exists('target'):
+        os.makedirs('target')
+    version = buildVersion()
+
+    # keep the go build cache inside target so CI containers that wipe
+    # $HOME can persist it as a cache artifact, and trim paths so cache
+    # keys survive a renamed checkout directory.
+    env = os.environ.copy()
+    env['GOCACHE'] = os.path.abspath('target/.gocache')
+    env['GOFLAGS'] = f'-p={os.cpu_count()}'
+    command = ['go', 'build', '-trimpath',
+               '-ldflags', f'-s -X main.version={version} {flags}',
+               '-o', 'target/bampf.raw', 'bampf']
+    subprocess.run(command, env=env, close_fds=False)
+    print(f"built binary with command: {' '.join(command)}")
+
+def buildVersion():
+    # Format the source and query git for the version string, skipping both
+    # when neither the repo head nor the source files have changed.
+    cache = 'target/.buildcache.json'
+    try:
+        head = subprocess.check_output(gitHeadCmd, close_fds=False).strip().decode()
+    except subprocess.CalledProcessError:
+        head = ''
+    newest = max([os.path.getmtime(src) for src in glob.iglob('../*.go')] or [0])
     try:
-        version = subprocess.check_output(shlex.split('git describe')).strip()
+        with open(cache) as infile:
+            cached = json.load(infile)
+        if cached['head'] == head and cached['mtime'] == newest:
+            return cached['version']
+    except (IOError, ValueError, KeyError):
+        pass
+    run(goFmtCmd)
+    try:
+        version = subprocess.check_output(gitDescribeCmd, close_fds=False).strip().decode()
     except subprocess.CalledProcessError:
         version = 'v0.0'
-    command = 'go build -ldflags "-s -X main.version='+version+' '+flags+'" -o target/bampf.raw bampf'
-    out, err = subprocess.Popen(command, universal_newlines=True, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    print('built binary with command: ' + command)
+    with open(cache, 'w') as outfile:
+        json.dump({'head': head, 'mtime': newest, 'version': version}, outfile)
+    return version
+
+def listAssets(root):
+    # Generate the asset file paths using scandir, whose DirEntry caches
+    # stat information and so avoids an extra stat syscall per file.
+    for sub in ('models', 'source', 'images', 'audio'):
+        with os.scandir(os.path.join(root, sub)) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    yield entry.path
 
 def zipAssets():
     # zip the resources and include them with the binary.
-    # chdir to get resource file zip proper names.
-    cwd = os.getcwd()
-    os.chdir('..')
-    subprocess.call(['zip', 'assets.zip']+glob.glob('models/*')+glob.glob('source/*')+
-                    glob.glob('images/*')+glob.glob('audio/*'))
-    os.chdir(cwd)
-    shutil.move('../assets.zip', 'target/assets.zip')
+    # Absolute source paths with archive names relative to the project
+    # root mean no chdir, keeping this safe beside concurrent steps.
+    # compresslevel 1 since the media files are already compressed.
+    root = os.path.abspath('..')
+    with zipfile.ZipFile('target/assets.zip', 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as assets:
+        for path in listAssets(root):
+            assets.write(path, os.path.relpath(path, root))
 
 def buildOSX():
-    print 'Building the osx application bundle.'
-    buildBinary('-linkmode=external')
-    run('mv target/bampf.raw target/bampf')
-    run('chmod +x target/bampf')
-    zipAssets()
+    print('Building the osx application bundle.')
+
+    # the go compile and the asset zip are independent, so overlap them.
+    if not os.path.exists('target'):
+        os.makedirs('target')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as pool:
+        binary = pool.submit(buildBinary, '-linkmode=external')
+        assets = pool.submit(zipAssets)
+        binary.result()
+        assets.result()
+    run(['mv', 'target/bampf.raw', 'target/bampf'])
+    run(['chmod', '+x', 'target/bampf'])
 
     # create the OSX application bundle directory structure.
     base = 'target/Bampf.app'
@@ -84,58 +151,158 @@ def buildOSX():
     os.makedirs(base + '/Resources')
 
     # create the osx bundle by putting everything in the proper directories.
-    run('cp Info.plist target/Bampf.app/Contents/')
-    run('cp target/bampf target/Bampf.app/Contents/MacOS/Bampf')
-    run('cp target/assets.zip target/Bampf.app/Contents/Resources/')
-    run('cp bampf.icns target/Bampf.app/Contents/Resources/Bampf.icns')
-
-    # Create a signed copy for self distribution.
-    if os.path.exists('target/dist'):
-        shutil.rmtree('target/dist')
-    os.makedirs('target/dist')
-    run('cp -r target/Bampf.app target/dist/Bampf.app')
-    pkgOSX('target/dist', '"Developer ID Application: XXX"', '"Developer ID Installer: Paul Ruest"')
-
-    # Create a signed copy for app store submission.
-    if os.path.exists('target/app'):
-        shutil.rmtree('target/app')
-    os.makedirs('target/app')
-    run('cp -r target/Bampf.app target/app/Bampf.app')
-    pkgOSX('target/app', '"3rd Party Mac Developer Application: Galvanized Logic Inc."',
-           '"3rd Party Mac Developer Installer: Galvanized Logic Inc."')
+    run(['cp', 'Info.plist', 'target/Bampf.app/Contents/'])
+    run(['cp', 'target/bampf', 'target/Bampf.app/Contents/MacOS/Bampf'])
+    run(['cp', 'target/assets.zip', 'target/Bampf.app/Contents/Resources/'])
+    run(['cp', 'bampf.icns', 'target/Bampf.app/Contents/Resources/Bampf.icns'])
+
+    # Stage a copy for self distribution and one for app store
+    # submission. Only the stale bundles are replaced; the signed
+    # packages and hash markers are kept so an unchanged rebuild can
+    # skip re-signing.
+    for outdir in ('target/dist', 'target/app'):
+        if os.path.exists(outdir + '/Bampf.app'):
+            shutil.rmtree(outdir + '/Bampf.app')
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        run(['cp', '-r', 'target/Bampf.app', outdir + '/Bampf.app'])
+
+    # Sign and package the two copies concurrently; codesign and
+    # productbuild are external processes with no shared state, so the
+    # two signing phases fully overlap.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        dist = pool.submit(pkgOSX, 'target/dist', '"Developer ID Application: XXX"',
+                           '"Developer ID Installer: Paul Ruest"')
+        app = pool.submit(pkgOSX, 'target/app',
+                          '"3rd Party Mac Developer Application: Galvanized Logic Inc."',
+                          '"3rd Party Mac Developer Installer: Galvanized Logic Inc."')
+        dist.result()
+        app.result()
+
+def bundleHash(bundle):
+    # Fingerprint a bundle from a sorted walk of its contents. File bytes
+    # are hashed, not mtimes, since the compile rewrites its outputs on
+    # every run even when they come out identical.
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(bundle):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(path, bundle).encode())
+            with open(path, 'rb') as infile:
+                for chunk in iter(lambda: infile.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
 
 def pkgOSX(outdir, akey, ikey):
-    run('codesign --force --entitlements Entitlements.plist --sign '+
-        akey+' --timestamp=none '+outdir+'/Bampf.app')
-    run('productbuild --version 1.0 --sign '+ikey+' --component '+
-        outdir+'/Bampf.app /Applications '+outdir+'/Bampf.pkg')
+    # Re-signing is multi-second work, so skip it when the bundle is
+    # byte-identical to what was last signed and packaged.
+    marker = os.path.join(outdir, '.signed-hash')
+    current = bundleHash(os.path.join(outdir, 'Bampf.app'))
+    if os.path.exists(marker) and os.path.exists(f'{outdir}/Bampf.pkg'):
+        with open(marker) as infile:
+            if infile.read() == current:
+                print(f'Signing skipped, {outdir}/Bampf.app unchanged.')
+                return
+
+    # Drop the stale marker before signing so a failed or interrupted
+    # sign can never be mistaken for a signed bundle on the next run.
+    if os.path.exists(marker):
+        os.remove(marker)
+
+    # sign and package with one shell so sequencing costs one fork, not two.
+    # runScript raises on failure, so the marker is only written after
+    # both tools exit cleanly.
+    runScript(f'codesign --force --entitlements Entitlements.plist --sign '
+              f'{akey} --timestamp=none {outdir}/Bampf.app && '
+              f'productbuild --version 1.0 --sign {ikey} --component '
+              f'{outdir}/Bampf.app /Applications {outdir}/Bampf.pkg')
+    with open(marker, 'w') as outfile:
+        outfile.write(current)
 
 def buildWindows():
-    print 'Building windows'
+    print('Building windows')
 
     # create the icon resource to include with the binary.
-    run('windres bampf.rc -O coff -o ../resources.syso')
+    run(['windres', 'bampf.rc', '-O', 'coff', '-o', '../resources.syso'])
 
     # build the raw binary and cleanup the generated icon (windows resource) file.
     buildBinary('-H windowsgui')
     os.remove('../resources.syso')
 
-    # combine the exe and the resources. Need to redirect output for cat to work.
+    # combine the exe and the resources without forking cat.
     zipAssets()
-    with open('target/bampf', "w") as outfile:
-        subprocess.call(['cat', 'target/bampf.raw', 'target/assets.zip'], stdout=outfile)
-    run('zip -A target/bampf')
-    run('mv target/bampf target/Bampf.exe')
+    with open('target/bampf', 'wb') as outfile:
+        for piece in ('target/bampf.raw', 'target/assets.zip'):
+            appendFile(outfile, piece)
+    run(['zip', '-A', 'target/bampf'])
+    run(['mv', 'target/bampf', 'target/Bampf.exe'])
+
+def appendFile(outfile, source):
+    # Append source to the open output file. sendfile copies entirely in
+    # kernel space; fall back to userspace copies where it is missing,
+    # notably on windows.
+    with open(source, 'rb') as infile:
+        if not hasattr(os, 'sendfile'):
+            shutil.copyfileobj(infile, outfile)
+            return
+        offset, remaining = 0, os.fstat(infile.fileno()).st_size
+        while remaining > 0:
+            sent = os.sendfile(outfile.fileno(), infile.fileno(), offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+
+def moveFile(args):
+    shutil.move(args[0], args[1])
+
+def copyFile(args):
+    # mirrors the cp and cp -r command forms used by the build.
+    if args[0] == '-r':
+        shutil.copytree(args[1], args[2])
+    elif os.path.isdir(args[1]):
+        shutil.copy2(args[0], os.path.join(args[1], os.path.basename(args[0])))
+    else:
+        shutil.copy2(args[0], args[1])
+
+def makeExecutable(args):
+    # only the chmod +x form is needed by the build.
+    mode = os.stat(args[1]).st_mode
+    os.chmod(args[1], mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+def removeFile(args):
+    for path in args:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+# simple file manipulation commands are handled in-process rather than
+# paying a fork+exec for each one.
+fileCommands = {'mv': moveFile, 'cp': copyFile, 'chmod': makeExecutable, 'rm': removeFile}
+
+def run(args):
+    # Execute a pre-tokenized command, keeping trivial file operations
+    # in-process. The build owns no sensitive file descriptors, so
+    # close_fds=False skips the descriptor-table scan before exec and
+    # lets python take its posix_spawn fast path.
+    if args[0] in fileCommands:
+        fileCommands[args[0]](args[1:])
+    else:
+        subprocess.call(args, close_fds=False)
 
-def run(command):
-    # execute command in the shell.
-    subprocess.call(shlex.split(command))
+def runScript(script):
+    # Execute a multi-command phase with a single shell invocation,
+    # raising CalledProcessError if any command in the phase fails.
+    subprocess.run(script, shell=True, executable='/bin/bash',
+                   check=True, close_fds=False)
 
 #------------------------------------------------------------------------------
 # Main program.
 
 def usage():
-    print 'Usage: build [clean] [lint] [src]'
+    print('Usage: build [clean] [lint] [src]')
 
 if __name__ == "__main__":
     options = {'clean'  : cleanProject,
@@ -144,7 +311,7 @@ if __name__ == "__main__":
     somethingBuilt = False
     for arg in sys.argv:
         if arg in options:
-            print 'Performing build ' + arg
+            print(f'Performing build {arg}')
             options[arg]()
             somethingBuilt = True
     if not somethingBuilt: